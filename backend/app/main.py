@@ -5,12 +5,14 @@ from fastapi import FastAPI, Request, Response, HTTPException, Header, status, A
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-import httpx, os, json, datetime, time, uuid, logging
+import asyncio, httpx, os, json, datetime, time, uuid, logging
 import jwt  # PyJWT
 from typing import Callable
 from pathlib import Path
 from dotenv import load_dotenv
 
+from . import sse
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Carga de .env local al paquete backend/app/.env (dev)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -42,6 +44,9 @@ N8N_TIMEOUT = float(os.getenv("N8N_TIMEOUT", "6.0"))  # seconds
 MAX_CONN    = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
 MAX_KEEP    = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
 
+# Revalidación en background de sesiones con /api/events abierto (0 = desactivado)
+SESSION_RECHECK_SEC = float(os.getenv("SESSION_RECHECK_SEC", "300"))
+
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
     format="%(asctime)s %(levelname)s %(message)s",
@@ -61,9 +66,19 @@ async def lifespan(app: FastAPI):
         limits=httpx.Limits(max_connections=MAX_CONN, max_keepalive_connections=MAX_KEEP),
         http2=False,
     )
+    sse.set_session_validator(_session_valid)
+    recheck = asyncio.create_task(_recheck_sessions()) if SESSION_RECHECK_SEC > 0 else None
     try:
         yield
     finally:
+        if recheck:
+            # Esperar la cancelación: una llamada a n8n en curso no debe usar _client ya cerrado
+            recheck.cancel()
+            try:
+                await recheck
+            except asyncio.CancelledError:
+                pass
+        sse.set_session_validator(None)
         await _client.aclose()
         _client = None
 
@@ -156,6 +171,40 @@ async def call_n8n(payload: dict) -> tuple[int, dict, str]:
 
     return r.status_code, data, r.text
 
+# Validez de sesión vía n8n (form 333). Devuelve (status, ok).
+async def _check_session(sid: str) -> tuple[int, bool]:
+    status_code, data, _ = await call_n8n({"form": 333, "sessionkey": sid})
+    return status_code, bool(data.get("result") or data.get("auth") or data.get("valid"))
+
+# Para /api/events: False solo si n8n responde 200 e inválida; si n8n falla, excepción (503)
+async def _session_valid(sid: str) -> bool:
+    status_code, ok = await _check_session(sid)
+    if status_code != 200:
+        raise RuntimeError(f"n8n session check returned {status_code}")
+    return ok
+
+# Solo una respuesta 200 explícita de n8n revoca; errores upstream no cierran streams
+def _revoke_if_invalid(sid: str, status_code: int, ok: bool, reason: str = "invalid"):
+    if status_code == 200 and not ok:
+        n = sse.revoke_session(sid, reason)
+        if BFF_DEBUG and n:
+            log.info("[sse] session-revoked reason=%s streams=%d", reason, n)
+
+async def _recheck_sessions():
+    """
+    Revalida una vez por sesión (no por pestaña) las sesiones con stream abierto
+    y empuja session-revoked a las que n8n ya no reconoce.
+    """
+    while True:
+        await asyncio.sleep(SESSION_RECHECK_SEC)
+        for sid in sse.active_sessions():
+            try:
+                status_code, ok = await _check_session(sid)
+            except Exception as e:
+                if BFF_DEBUG: log.warning("[sse] recheck error: %r", e)
+                continue
+            _revoke_if_invalid(sid, status_code, ok, "expired")
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Routes (router prefix /api)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -173,9 +222,9 @@ async def refresh_session(req: Request):
     if not sid:
         return Response(status_code=status.HTTP_401_UNAUTHORIZED)
 
-    status_code, data, _ = await call_n8n({"form": 333, "sessionkey": sid})
-    ok = bool(data.get("result") or data.get("auth") or data.get("valid"))
+    status_code, ok = await _check_session(sid)
     if status_code != 200 or not ok:
+        _revoke_if_invalid(sid, status_code, ok)
         return Response(status_code=status.HTTP_401_UNAUTHORIZED)
 
     # Re-emite cookie para extender expiración (ajusta max_age si usas expires_at)
@@ -248,10 +297,17 @@ async def session(req: Request):
         if BFF_DEBUG: log.info("[/api/session] early_false (no sid)")
         return {"result": False}
 
-    status_code, data, _ = await call_n8n({"form": 333, "sessionkey": sid})
-    ok = bool(data.get("result") or data.get("auth") or data.get("valid"))
+    try:
+        status_code, ok = await _check_session(sid)
+    except httpx.HTTPError as e:
+        if BFF_DEBUG: log.warning("[/api/session] n8n error: %r", e)
+        status_code, ok = 0, False
     if BFF_DEBUG:
         log.info("[/api/session] n8n_status=%s ok=%s", status_code, ok)
+    # Falla de n8n ≠ sesión inválida: 502 para que el cliente reintente y no cierre sesión
+    if status_code != 200:
+        return JSONResponse({"result": False, "upstream_error": True}, status_code=502)
+    _revoke_if_invalid(sid, status_code, ok)
     return {"result": ok}
 
 @app.post("/api/logout")
@@ -264,6 +320,7 @@ async def logout(req: Request, res: Response):
         pass
     if sid:
         await call_n8n({"form": 222, "sessionkey": sid})
+        sse.revoke_session(sid, "logout")
     
     # 🔥 Mata todas las variantes conocidas (paths)
     for p in ("/api", "/"):
@@ -309,3 +366,7 @@ async def echo(req: Request):
 
 # Importante: montar el router /api
 app.include_router(router)
+# /events bajo /api: la cookie de sesión tiene path=/api y Kong/Vite solo enrutan /api al BFF
+app.include_router(sse.events_router, prefix="/api")
+# /internal/* en la raíz: Kong no lo enruta, solo se alcanza directo al puerto del BFF
+app.include_router(sse.router)
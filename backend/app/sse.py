@@ -1,61 +1,372 @@
 # backend/app/sse.py
-import asyncio, json, os, time
-from typing import AsyncGenerator
+import asyncio, hmac, json, os, time
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable
 from fastapi import APIRouter, Request, Response, HTTPException, Header
 from starlette.responses import StreamingResponse
 
+# Endpoints internos (/internal/*): se montan en la raíz, fuera de /api, que es lo
+# único que Kong enruta al BFF. /events va aparte porque sí se expone bajo /api.
 router = APIRouter()
+events_router = APIRouter()
 
-# Conexiones activas (cada conexión es una asyncio.Queue)
-_connections: set[asyncio.Queue] = set()
+# Conexiones activas: asyncio.Queue de chunks SSE ya serializados -> session id
+_connections: dict[asyncio.Queue, str] = {}
+# Las mismas conexiones indexadas por session id (para empujar session-revoked)
+_by_session: dict[str, set[asyncio.Queue]] = {}
 
 # Ping interval para mantener viva la conexión por proxies
 PING_EVERY_SEC = 20
-BROADCAST_SECRET = os.getenv("SSE_BROADCAST_SECRET", "change-me")  # setéalo en env
+# Chunks pendientes por suscriptor; si se llena, el cliente va lento y se le corta
+SUBSCRIBER_QUEUE_MAX = max(2, int(os.getenv("SSE_SUBSCRIBER_QUEUE_MAX", "256")))
+_DEFAULT_SECRET = "change-me"
+BROADCAST_SECRET = os.getenv("SSE_BROADCAST_SECRET", _DEFAULT_SECRET)  # setéalo en env
+SESSION_COOKIE = os.environ.get("SESSION_COOKIE", "jsessionid")
 
-async def _event_stream() -> AsyncGenerator[bytes, None]:
+# Validador de sesión (sid -> bool); lo registra main.py para no importar n8n aquí.
+# False = sesión inválida; una excepción = upstream no disponible.
+_session_validator: Callable[[str], Awaitable[bool]] | None = None
+
+# Ingesta NDJSON: eventos que llegan dentro de esta ventana se agrupan en un solo write
+COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "5"))
+COALESCE_MAX_EVENTS = int(os.getenv("SSE_COALESCE_MAX_EVENTS", "500"))
+# Tope por línea NDJSON; las más largas se descartan (y cuentan en rejected)
+NDJSON_MAX_LINE = int(os.getenv("SSE_NDJSON_MAX_LINE", str(64 * 1024)))
+# Eventos parseados en espera de fan-out; lleno = se deja de leer el body (backpressure)
+INGEST_QUEUE_MAX = int(os.getenv("SSE_INGEST_QUEUE_MAX", "2000"))
+
+_NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+_END = object()
+
+def set_session_validator(fn: Callable[[str], Awaitable[bool]] | None):
+    global _session_validator
+    _session_validator = fn
+
+def active_sessions() -> list[str]:
+    return list(_by_session.keys())
+
+def _register(sid: str) -> asyncio.Queue:
+    q: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_MAX)
+    _connections[q] = sid
+    _by_session.setdefault(sid, set()).add(q)
+    return q
+
+def _unregister(sid: str, q: asyncio.Queue):
+    _connections.pop(q, None)
+    queues = _by_session.get(sid)
+    if queues is not None:
+        queues.discard(q)
+        if not queues:
+            _by_session.pop(sid, None)
+
+async def _event_stream(sid: str, q: asyncio.Queue) -> AsyncGenerator[bytes, None]:
     """
-    Genera chunks SSE. Mantiene un Queue por cliente.
+    Genera chunks SSE desde el Queue del cliente, registrado bajo su sesión.
+    Si hay varios chunks pendientes se envían juntos en un solo write.
+    Un None en la cola cierra el stream (sesión revocada).
     """
-    q: asyncio.Queue = asyncio.Queue()
-    _connections.add(q)
     try:
         last_ping = time.time()
         while True:
             try:
                 # Espera evento o hace ping cada PING_EVERY_SEC
                 timeout = max(0.0, PING_EVERY_SEC - (time.time() - last_ping))
-                event = await asyncio.wait_for(q.get(), timeout=timeout)
-                yield f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                chunks = [await asyncio.wait_for(q.get(), timeout=timeout)]
+                while not q.empty():
+                    chunks.append(q.get_nowait())
+                if None in chunks:
+                    rest = b"".join(chunks[:chunks.index(None)])
+                    if rest:
+                        yield rest
+                    return
+                yield b"".join(chunks)
             except asyncio.TimeoutError:
                 # comentario/ping SSE (no data) para evitar timeouts de proxy
                 yield b": ping\n\n"
                 last_ping = time.time()
     finally:
-        _connections.discard(q)
+        _unregister(sid, q)
+
+def _close(q: asyncio.Queue, last: bytes = b""):
+    """
+    Cierra el stream: descarta lo pendiente (la cola puede estar llena),
+    encola el último chunk si hay y el None que termina _event_stream.
+    """
+    while not q.empty():
+        q.get_nowait()
+    if last:
+        q.put_nowait(last)
+    q.put_nowait(None)
+
+def _fanout(events: list[dict]) -> int:
+    """
+    Serializa el lote una sola vez y lo encola en cada conexión.
+    Un suscriptor con la cola llena se da de baja y su stream se cierra.
+    Devuelve a cuántos suscriptores se entregó.
+    """
+    if not events or not _connections:
+        return 0
+    chunk = b"".join(f"data: {json.dumps(e)}\n\n".encode("utf-8") for e in events)
+    delivered = 0
+    for q, sid in list(_connections.items()):
+        try:
+            q.put_nowait(chunk)
+            delivered += 1
+        except asyncio.QueueFull:
+            _unregister(sid, q)
+            _close(q)
+    return delivered
 
-@router.get("/events")
+def revoke_session(sid: str, reason: str = "revoked") -> int:
+    """
+    Empuja `session-revoked` solo a los streams de esa sesión y los cierra.
+    Devuelve cuántos streams fueron notificados.
+    """
+    queues = _by_session.pop(sid, None)
+    if not queues:
+        return 0
+    chunk = f"event: session-revoked\ndata: {json.dumps({'reason': reason})}\n\n".encode("utf-8")
+    for q in queues:
+        _connections.pop(q, None)
+        _close(q, chunk)
+    return len(queues)
+
+def _check_secret(authorization: str):
+    # Sin secreto propio (vacío o el default) los endpoints internos no funcionan
+    if not BROADCAST_SECRET or BROADCAST_SECRET == _DEFAULT_SECRET:
+        raise HTTPException(status_code=503, detail="SSE_BROADCAST_SECRET not configured")
+    # Seguridad simple por header (Bearer), comparación en tiempo constante
+    token = authorization.removeprefix("Bearer ")
+    if not hmac.compare_digest(token.encode("utf-8"), BROADCAST_SECRET.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+async def _ndjson_events(request: Request, stats: dict) -> AsyncGenerator[dict, None]:
+    """
+    Parsea el cuerpo NDJSON a medida que llega (una línea = un evento).
+    Líneas inválidas, que no son objeto o más largas que NDJSON_MAX_LINE se
+    cuentan en stats["rejected"]. Solo se busca "\n" en el chunk nuevo.
+    """
+    buf = bytearray()
+    skipping = False  # descartando el resto de una línea demasiado larga
+    async for chunk in request.stream():
+        start = 0
+        while True:
+            nl = chunk.find(b"\n", start)
+            piece = chunk[start:] if nl < 0 else chunk[start:nl]
+            if not skipping:
+                if len(buf) + len(piece) > NDJSON_MAX_LINE:
+                    stats["rejected"] += 1
+                    buf.clear()
+                    skipping = True
+                else:
+                    buf += piece
+            if nl < 0:
+                break
+            start = nl + 1
+            if skipping:
+                skipping = False
+                continue
+            event = _parse_line(bytes(buf), stats)
+            buf.clear()
+            if event is not None:
+                yield event
+    if not skipping:
+        event = _parse_line(bytes(buf), stats)
+        if event is not None:
+            yield event
+
+def _parse_line(line: bytes, stats: dict) -> dict | None:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        event = json.loads(line)
+    except (ValueError, RecursionError):  # RecursionError: anidamiento excesivo
+        event = None
+    if not isinstance(event, dict):
+        stats["rejected"] += 1
+        return None
+    return event
+
+async def _coalesce(source: AsyncIterator[dict], window_sec: float, max_events: int) -> AsyncGenerator[list[dict], None]:
+    """
+    Agrupa eventos: el lote se abre con el primer evento y se cierra al
+    vencer la ventana, al llegar a max_events o al terminar el stream.
+    """
+    inbox: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_MAX)
+
+    async def pump():
+        try:
+            async for event in source:
+                await inbox.put(event)
+        except Exception as e:
+            await inbox.put(e)
+        finally:
+            await inbox.put(_END)
+
+    task = asyncio.create_task(pump())
+    loop = asyncio.get_running_loop()
+    try:
+        done = False
+        while not done:
+            item = await inbox.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            batch = [item]
+            deadline = loop.time() + window_sec
+            while len(batch) < max_events:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(inbox.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _END:
+                    done = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch.append(item)
+            yield batch
+    finally:
+        task.cancel()
+        try:
+            await task
+        except BaseException:
+            pass
+
+class _ProgressResponse(StreamingResponse):
+    """
+    StreamingResponse sin el listener de desconexión: ese listener consume
+    receive() y le robaría los chunks al body NDJSON que aún se está leyendo.
+    """
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async for chunk in self.body_iterator:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+async def _ndjson_progress(request: Request) -> AsyncGenerator[bytes, None]:
+    """
+    Fan-out de la subida NDJSON en una task propia, que no espera al writer de
+    la respuesta: los eventos llegan a los suscriptores aunque el productor no
+    lea la respuesta. El progreso es best-effort: mientras el writer está
+    bloqueado los lotes se acumulan y salen en una sola línea
+    {"batch" (último), "merged", "events", "delivered"}. La línea final
+    {"done", "batches", "events", "delivered", "rejected"} lleva totales exactos.
+    """
+    stats = {"rejected": 0}
+    totals = {"batches": 0, "events": 0, "delivered": 0}
+    pending = {"merged": 0, "events": 0, "delivered": 0}
+    ready = asyncio.Event()
+
+    async def ingest():
+        source = _ndjson_events(request, stats)
+        async for batch in _coalesce(source, COALESCE_MS / 1000.0, COALESCE_MAX_EVENTS):
+            delivered = _fanout(batch)
+            totals["batches"] += 1
+            totals["events"] += len(batch)
+            totals["delivered"] += delivered
+            pending["merged"] += 1
+            pending["events"] += len(batch)
+            pending["delivered"] += delivered
+            ready.set()
+
+    task = asyncio.create_task(ingest())
+    try:
+        while True:
+            finished = task.done()
+            if not finished:
+                waiter = asyncio.create_task(ready.wait())
+                await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+            ready.clear()
+            if pending["merged"]:
+                line = {"batch": totals["batches"], **pending}
+                pending.update(merged=0, events=0, delivered=0)
+                yield (json.dumps(line) + "\n").encode("utf-8")
+            if finished:
+                break
+        final = {"done": True, **totals, "rejected": stats["rejected"]}
+        if not task.cancelled() and task.exception() is not None:
+            final.update(done=False, error=type(task.exception()).__name__)
+        yield (json.dumps(final) + "\n").encode("utf-8")
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+
+@events_router.get("/events")
 async def events(request: Request):
+    # Autenticado con la cookie de sesión (path=/api, por eso se monta bajo /api)
+    sid = request.cookies.get(SESSION_COOKIE)
+    if not sid:
+        raise HTTPException(status_code=401, detail="unauthorized")
+    # Se registra antes de validar: un logout durante la validación encuentra
+    # este stream y le deja session-revoked en la cola
+    q = _register(sid)
+    try:
+        ok = await _session_validator(sid) if _session_validator is not None else True
+    except BaseException as e:
+        _unregister(sid, q)
+        if isinstance(e, Exception):
+            raise HTTPException(status_code=503, detail="session check unavailable")
+        raise
+    if not ok:
+        _unregister(sid, q)
+        raise HTTPException(status_code=401, detail="unauthorized")
     headers = {
         "Cache-Control": "no-cache",
         "Connection": "keep-alive",
         # Desactiva buffering intermedio (Kong/Nginx suelen respetar esto)
         "X-Accel-Buffering": "no",
     }
-    return StreamingResponse(_event_stream(), media_type="text/event-stream", headers=headers)
+    return StreamingResponse(_event_stream(sid, q), media_type="text/event-stream", headers=headers)
 
 @router.post("/internal/broadcast")
-async def internal_broadcast(payload: dict, authorization: str = Header(default="")):
-    # Seguridad simple por header (Bearer):
-    token = authorization.replace("Bearer ", "")
-    if token != BROADCAST_SECRET:
-        raise HTTPException(status_code=401, detail="unauthorized")
-    # Fan-out
-    if not _connections:
-        return {"broadcasted": 0}
-    for q in list(_connections):
-        try:
-            q.put_nowait(payload)
-        except Exception:
-            pass
-    return {"broadcasted": len(_connections)}
+async def internal_broadcast(request: Request, authorization: str = Header(default="")):
+    """
+    Acepta:
+    - un objeto JSON (un evento) → {"broadcasted": n}
+    - un array JSON de eventos → se entrega en lotes de hasta COALESCE_MAX_EVENTS
+    - NDJSON en streaming (content-type application/x-ndjson): cada línea entra
+      al fan-out según llega, agrupada en ventanas de COALESCE_MS; la respuesta
+      también es NDJSON, con una línea de conteos por lote mientras dura la subida
+    Para el array responde los conteos de entrega por lote.
+    """
+    _check_secret(authorization)
+    ctype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    if ctype in _NDJSON_TYPES:
+        return _ProgressResponse(_ndjson_progress(request), media_type="application/x-ndjson")
+
+    try:
+        payload = await request.json()
+    except (ValueError, RecursionError):
+        raise HTTPException(status_code=400, detail="invalid json")
+    if isinstance(payload, dict):
+        # Compatibilidad: un solo evento
+        return {"broadcasted": _fanout([payload])}
+    if not isinstance(payload, list) or not all(isinstance(e, dict) for e in payload):
+        raise HTTPException(status_code=422, detail="expected an event object or an array of event objects")
+    batches: list[dict] = []
+    for i in range(0, len(payload), COALESCE_MAX_EVENTS):
+        batch = payload[i:i + COALESCE_MAX_EVENTS]
+        batches.append({"events": len(batch), "delivered": _fanout(batch)})
+    return {"events": len(payload), "rejected": 0, "batches": batches}
+
+@router.post("/internal/revoke")
+async def internal_revoke(payload: dict, authorization: str = Header(default="")):
+    """
+    Para checks upstream (n8n u otros): {"sessionkey": "...", "reason": "..."}.
+    """
+    _check_secret(authorization)
+    sid = payload.get("sessionkey")
+    if not sid:
+        raise HTTPException(status_code=400, detail="sessionkey required")
+    return {"revoked": revoke_session(sid, payload.get("reason") or "revoked")}
@@ -1,30 +1,82 @@
 import React, { useEffect, useState } from "react";
 import { useNavigate } from "react-router-dom";
 
+// Validez de sesión compartida entre montajes: se valida una vez por HTTP y
+// luego el BFF avisa por SSE (`session-revoked`) si la sesión deja de ser válida.
+let sessionValid: boolean | null = null;
+let events: EventSource | null = null;
+const listeners = new Set<() => void>();
+const RECHECK_MS = 5000;
+
+async function checkSession(signal?: AbortSignal): Promise<boolean> {
+  const res = await fetch('/api/session', {
+    method: 'POST',
+    credentials: 'include',
+    headers: { 'content-type': 'application/json', 'x-csrf-token': '1' },
+    body: JSON.stringify({ form: 333 }),
+    signal,
+  });
+  if (res.status >= 500) throw new Error(`session check ${res.status}`);
+  if (!res.ok) return false;
+  const json = await res.json();
+  if (json?.upstream_error) throw new Error('session check upstream error');
+  return json?.result === true;
+}
+
+// Solo `session-revoked` (o un re-check que diga inválida) cuenta como revocación
+function revoke() {
+  sessionValid = null;
+  events?.close();
+  events = null;
+  listeners.forEach((fn) => fn());
+}
+
+// Stream cerrado sin reintento (401/502/503 al conectar): re-valida por HTTP;
+// si el BFF no responde, reintenta más tarde sin sacar al usuario
+async function recheck() {
+  try {
+    if (await checkSession()) { sessionValid = true; openEvents(); }
+    else revoke();
+  } catch {
+    setTimeout(recheck, RECHECK_MS);
+  }
+}
+
+function openEvents() {
+  if (events) return;
+  events = new EventSource('/api/events', { withCredentials: true });
+  events.addEventListener('session-revoked', revoke);
+  events.onerror = () => {
+    if (events?.readyState !== EventSource.CLOSED) return;  // el navegador reconecta solo
+    sessionValid = null;
+    events = null;
+    setTimeout(recheck, RECHECK_MS);
+  };
+}
+
 export default function Protected({ children }: { children: React.ReactNode }) {
   const navigate = useNavigate();
-  const [state, setState] = useState<'loading'|'ok'|'deny'>('loading');
+  const [state, setState] = useState<'loading'|'ok'|'deny'>(sessionValid ? 'ok' : 'loading');
 
   useEffect(() => {
+    const deny = () => { setState('deny'); navigate('/', { replace: true }); };
+    listeners.add(deny);
+    if (sessionValid) return () => { listeners.delete(deny); };
+
     const ac = new AbortController();
     (async () => {
       try {
-        const res = await fetch('/api/session', {
-          method: 'POST',
-          credentials: 'include',
-          headers: { 'content-type': 'application/json', 'x-csrf-token': '1' },
-          body: JSON.stringify({ form: 333 }),
-          signal: ac.signal,
-        });
-        if (!res.ok) { setState('deny'); return navigate('/', { replace: true }); }
-        const json = await res.json();
-        if (json?.result === true) setState('ok');
-        else { setState('deny'); navigate('/', { replace: true }); }
+        if (await checkSession(ac.signal)) {
+          sessionValid = true;
+          openEvents();
+          setState('ok');
+        }
+        else deny();
       } catch {
-        if (!ac.signal.aborted) { setState('deny'); navigate('/', { replace: true }); }
+        if (!ac.signal.aborted) deny();
       }
     })();
-    return () => ac.abort();
+    return () => { listeners.delete(deny); ac.abort(); };
   }, [navigate]);
 
   if (state === 'loading') return <div className="p-6 text-sm">Validando sesión… / Validating session…</div>;